@@ -1,5 +1,5 @@
 # app.py — Monsieur Darmon (admin par e‑mail, validations, historiques)
-import io, re, unicodedata, os
+import io, re, unicodedata, os, hashlib
 from datetime import datetime
 from pathlib import Path
 import numpy as np
@@ -9,6 +9,7 @@ from reportlab.lib.pagesizes import A4, landscape
 from reportlab.lib import colors
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet
+from openpyxl import Workbook
 
 # -----------------------------------------------------------------------------
 # Configuration
@@ -67,16 +68,22 @@ def to_numeric_safe(x):
     try: return float(s)
     except: return 0.0
 
+# Formats de durée reconnus (partagés avec le contrôle qualité)
+DURATION_HMS_RE = r'^\d{1,2}:\d{1,2}(?::\d{1,2})?$'
+DURATION_H_RE = r'(\d+)\s*h'
+DURATION_M_RE = r'(\d+)\s*m'
+DURATION_HM_QC_RE = r'\d+\s*[hm]'  # DURATION_H_RE | DURATION_M_RE sans groupe, pour str.contains
+
 def parse_duration_to_hours(x) -> float:
     if pd.isna(x): return 0.0
     s = str(x).strip().lower()
     try: return float(s.replace(',', '.'))
     except: pass
-    if re.match(r'^\d{1,2}:\d{1,2}(:\d{1,2})?$', s):
+    if re.match(DURATION_HMS_RE, s):
         parts = [int(p) for p in s.split(':')]
         h = parts[0]; m = parts[1] if len(parts)>1 else 0; sec = parts[2] if len(parts)>2 else 0
         return h + m/60 + sec/3600
-    h = re.search(r'(\d+)\s*h', s); m = re.search(r'(\d+)\s*m', s)
+    h = re.search(DURATION_H_RE, s); m = re.search(DURATION_M_RE, s)
     if h or m:
         hh = int(h.group(1)) if h else 0; mm = int(m.group(1)) if m else 0
         return hh + mm/60
@@ -115,6 +122,124 @@ def normalize(df: pd.DataFrame) -> pd.DataFrame:
         out[c] = out[c].astype(str)
     return out
 
+# -----------------------------------------------------------------------------
+# Contrôle qualité (juste après la lecture, avant les calculs)
+# -----------------------------------------------------------------------------
+QC_MAX_DAYS = 31
+QC_MAX_HOURS = 31 * 24
+QC_SAMPLE = 5
+
+def _blank_mask(s: pd.Series) -> pd.Series:
+    if pd.api.types.is_numeric_dtype(s):
+        return s.isna()
+    return s.isna() | s.astype(str).str.strip().eq('')
+
+def _numeric_text(s: pd.Series) -> pd.Series:
+    return (s.astype(str).str.strip().str.lower()
+             .str.replace(' ', '', regex=False).str.replace(',', '.', regex=False))
+
+def _unparsed_number_mask(s: pd.Series) -> pd.Series:
+    """Valeurs non vides que to_numeric_safe remplacerait silencieusement par 0."""
+    if pd.api.types.is_numeric_dtype(s):
+        return pd.Series(False, index=s.index)
+    return ~_blank_mask(s) & pd.to_numeric(_numeric_text(s), errors='coerce').isna()
+
+def _unparsed_duration_mask(s: pd.Series) -> pd.Series:
+    """Valeurs non vides que parse_duration_to_hours ramènerait à 0.0."""
+    if pd.api.types.is_numeric_dtype(s):
+        return pd.Series(False, index=s.index)
+    # Même normalisation que parse_duration_to_hours (pas de suppression des espaces)
+    txt = s.astype(str).str.strip().str.lower()
+    ok = pd.to_numeric(txt.str.replace(',', '.', regex=False), errors='coerce').notna()
+    ok |= txt.str.match(DURATION_HMS_RE) | txt.str.contains(DURATION_HM_QC_RE)
+    return ~_blank_mask(s) & ~ok
+
+def _periods(norm: pd.DataFrame) -> set:
+    p = norm['periode'].astype(str).str.strip()
+    return set(p[~p.isin(['', 'nan'])].unique())
+
+def scan_quality(files: list) -> pd.DataFrame:
+    """Rapport d'anomalies vectorisé.
+
+    files : [(libellé, brut, normalisé), ...], le mois courant en premier.
+    Retourne un DataFrame (niveau, fichier, controle, lignes, detail), vide si tout est OK.
+    """
+    issues = []
+
+    def add(niveau, fichier, controle, mask=None, ids=None, detail=''):
+        # Sans masque : contrôle au niveau du fichier, 'lignes' reste vide
+        n = None
+        if mask is not None:
+            n = int(mask.sum())
+            if n == 0:
+                return
+            if ids is not None:
+                sample = ids[mask.reindex(ids.index, fill_value=False)].drop_duplicates().head(QC_SAMPLE).tolist()
+                detail = (detail + ' ' if detail else '') + 'ex. : ' + ', '.join(map(str, sample))
+        issues.append({'niveau': niveau, 'fichier': fichier, 'controle': controle, 'lignes': n, 'detail': detail})
+
+    cur_periods = set()
+    for i, (label, raw, norm) in enumerate(files):
+        ids = norm['creator_id']
+        missing = [v for v in COLS.values() if v not in raw.columns]
+        if missing:
+            add('Erreur', label, 'Colonnes manquantes', detail=f"{len(missing)} : " + ' | '.join(missing))
+        if 'ID créateur(trice)' not in raw.columns:
+            add('Info', label, "Colonne 'ID créateur(trice)' absente (nom d'utilisateur utilisé)")
+
+        for key in ['diamants', 'jours_live']:
+            if COLS[key] in raw.columns:
+                add('Erreur', label, f"Valeurs non numériques : {COLS[key]}",
+                    _unparsed_number_mask(raw[COLS[key]]), ids)
+        if COLS['duree_live'] in raw.columns:
+            add('Erreur', label, f"Durées illisibles : {COLS['duree_live']}",
+                _unparsed_duration_mask(raw[COLS['duree_live']]), ids)
+
+        add('Erreur', label, 'creator_id en double', ids.duplicated(keep=False), ids)
+        add('Attention', label, f'Jours hors plage (0–{QC_MAX_DAYS})',
+            (norm['jours_live'] < 0) | (norm['jours_live'] > QC_MAX_DAYS), ids)
+        add('Attention', label, f'Heures hors plage (0–{QC_MAX_HOURS})',
+            (norm['heures_live'] < 0) | (norm['heures_live'] > QC_MAX_HOURS), ids)
+
+        periods = _periods(norm)
+        if i == 0:
+            cur_periods = periods
+            if len(periods) > 1:
+                add('Attention', label, 'Plusieurs périodes dans le mois courant',
+                    detail=f"{len(periods)} périodes : " + ', '.join(sorted(periods)[:QC_SAMPLE]))
+        elif cur_periods:
+            same = sorted(periods & cur_periods)
+            if same:
+                add('Erreur', label, 'Même période que le mois courant', detail=', '.join(same[:QC_SAMPLE]))
+            later = sorted(p for p in periods - cur_periods if p > max(cur_periods))
+            if later:
+                add('Attention', label, 'Période postérieure au mois courant',
+                    detail=f"{len(later)} période(s) : " + ', '.join(later[:QC_SAMPLE]))
+
+    report = pd.DataFrame(issues, columns=['niveau', 'fichier', 'controle', 'lignes', 'detail'])
+    return report.astype({'lignes': 'Int64'})
+
+def quality_report(files: list, fp: str) -> pd.DataFrame:
+    """Rapport gardé en session pour l'empreinte des fichiers : pas de nouveau scan à chaque interaction."""
+    cached = st.session_state.get('_quality_report')
+    if cached is None or cached[0] != fp:
+        cached = (fp, scan_quality(files))
+        st.session_state['_quality_report'] = cached
+    return cached[1]
+
+def show_quality_report(report: pd.DataFrame):
+    if report is None or report.empty:
+        return
+    # Les lignes 'Info' (ex. ID créateur absent, cas normal) ne déclenchent pas d'alerte
+    anomalies = report[report['niveau'] != 'Info']
+    if anomalies.empty:
+        return
+    n_err = int((anomalies['niveau'] == 'Erreur').sum())
+    msg = f"Contrôle qualité : {len(anomalies)} anomalie(s) détectée(s), dont {n_err} erreur(s). Vérifie les fichiers avant de valider les récompenses."
+    (st.error if n_err else st.warning)(msg)
+    with st.expander('Rapport de contrôle qualité', expanded=bool(n_err)):
+        st.dataframe(report, hide_index=True, use_container_width=True)
+
 # -----------------------------------------------------------------------------
 # Règles (NOUVELLE RÉMUNÉRATION 2026)
 # -----------------------------------------------------------------------------
@@ -369,21 +494,126 @@ def safe_pdf(label,title,df,file):
 # -----------------------------------------------------------------------------
 # Historique validations
 # -----------------------------------------------------------------------------
+VALIDATION_COLS = ['creator_id','periode','valide_recompense','valide_bonus','timestamp_iso']
+VALIDATION_KEY = ['creator_id','periode']
+TRUE_VALUES = ['true','1','yes','oui']
+
 def load_validations() -> pd.DataFrame:
     if HIST_FILE.exists():
         try:
             return pd.read_csv(HIST_FILE, dtype=str)
         except Exception:
-            return pd.DataFrame(columns=['creator_id','periode','valide_recompense','valide_bonus','timestamp_iso'])
-    return pd.DataFrame(columns=['creator_id','periode','valide_recompense','valide_bonus','timestamp_iso'])
+            return pd.DataFrame(columns=VALIDATION_COLS)
+    return pd.DataFrame(columns=VALIDATION_COLS)
+
+def _index_validations(vals: pd.DataFrame) -> pd.DataFrame:
+    """Indexe par (creator_id, periode) et parse les booléens."""
+    vals = vals.reindex(columns=VALIDATION_COLS)
+    for c in ['valide_recompense','valide_bonus']:
+        vals[c] = vals[c].astype(str).str.lower().isin(TRUE_VALUES)
+    return (vals.astype({'creator_id': str, 'periode': str})
+                .drop_duplicates(subset=VALIDATION_KEY, keep='last')
+                .set_index(VALIDATION_KEY)
+                .sort_index())
+
+def validations_index() -> pd.DataFrame:
+    """Validations indexées par (creator_id, periode), booléens déjà parsés.
+
+    Cache de lecture gardé en session : le CSV n'est relu qu'après un
+    enregistrement ou un « Forcer relecture ».
+    """
+    idx = st.session_state.get('_validations_idx')
+    if idx is None:
+        idx = _index_validations(load_validations())
+        st.session_state['_validations_idx'] = idx
+    return idx
 
 def save_validations(df_vals: pd.DataFrame):
-    prev = load_validations()
-    allv = pd.concat([prev, df_vals], ignore_index=True)
-    allv['timestamp_iso'] = allv['timestamp_iso'].fillna(datetime.utcnow().isoformat())
-    allv = (allv.sort_values('timestamp_iso')
-                 .drop_duplicates(subset=['creator_id','periode'], keep='last'))
-    allv.to_csv(HIST_FILE, index=False)
+    """Fusionne uniquement les lignes fournies (modifiées) dans le CSV tel qu'il est sur disque."""
+    if df_vals is None or df_vals.empty:
+        return
+    # Relecture du fichier : ne pas écraser ce qu'une autre session a enregistré
+    disk = _index_validations(load_validations())
+    upd = df_vals.reindex(columns=VALIDATION_COLS).copy()
+    upd['timestamp_iso'] = upd['timestamp_iso'].fillna(datetime.utcnow().isoformat())
+    upd = (upd.astype({'creator_id': str, 'periode': str})
+              .drop_duplicates(subset=VALIDATION_KEY, keep='last')
+              .set_index(VALIDATION_KEY))
+    allv = pd.concat([disk[~disk.index.isin(upd.index)], upd]).sort_values('timestamp_iso')
+    allv.reset_index().to_csv(HIST_FILE, index=False)
+    # Le cache de session reprend l'état écrit
+    st.session_state['_validations_idx'] = allv.sort_index()
+
+# -----------------------------------------------------------------------------
+# Exports CSV / XLSX
+# -----------------------------------------------------------------------------
+EXPORT_CHUNK_ROWS = 50_000
+EXPORT_STATE_PREFIX = '_export_'
+XLSX_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def _iter_sheet_rows(df: pd.DataFrame, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """En-tête puis lignes, converties par blocs (NaN -> cellule vide)."""
+    yield [str(c) for c in df.columns]
+    for start in range(0, len(df), chunk_rows):
+        block = df.iloc[start:start + chunk_rows].astype(object)
+        block = block.where(block.notna(), None)
+        yield from block.itertuples(index=False, name=None)
+
+def export_csv(df: pd.DataFrame) -> bytes:
+    """CSV écrit par blocs de lignes directement en octets (pas de chaîne complète intermédiaire)."""
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False, encoding='utf-8', chunksize=EXPORT_CHUNK_ROWS)
+    return buf.getvalue()
+
+def export_xlsx(sheets: dict) -> bytes:
+    """Classeur multi-feuilles en mode write-only (mémoire constante côté openpyxl)."""
+    wb = Workbook(write_only=True)
+    for name, df in sheets.items():
+        ws = wb.create_sheet(title=name[:31])
+        for row in _iter_sheet_rows(df if df is not None else pd.DataFrame()):
+            ws.append(row)
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+def validations_for(crea: pd.DataFrame) -> pd.DataFrame:
+    """Validations enregistrées pour les créateurs/périodes du tableau courant."""
+    idx = validations_index()
+    if crea is None or crea.empty or idx.empty:
+        return pd.DataFrame(columns=VALIDATION_COLS)
+    keys = pd.MultiIndex.from_frame(crea[VALIDATION_KEY].astype(str).drop_duplicates())
+    return idx.loc[keys[keys.isin(idx.index)]].reset_index()
+
+def fingerprint(*parts) -> str:
+    """Empreinte des données d'un export : octets bruts et/ou DataFrames (hash complet, vectorisé)."""
+    h = hashlib.sha1()
+    for p in parts:
+        if isinstance(p, pd.DataFrame):
+            h.update('|'.join(map(str, p.columns)).encode('utf-8'))
+            h.update(pd.util.hash_pandas_object(p, index=True).to_numpy().tobytes())
+        else:
+            h.update(p if isinstance(p, bytes) else str(p).encode('utf-8'))
+    return h.hexdigest()
+
+def prepared_download(key, label, file, mime, fp, build):
+    """Export construit à la demande et gardé en session avec l'empreinte de ses données.
+
+    Dès que l'empreinte ne correspond plus (nouveau fichier, édition, validation),
+    le contenu préparé est oublié : on ne propose jamais un fichier périmé.
+    """
+    key = EXPORT_STATE_PREFIX + key
+    slot = st.session_state.get(key)
+    if slot is not None and slot[0] != fp:
+        st.session_state.pop(key, None); slot = None
+    if st.button(f'Préparer {label}', key=key + '_prepare'):
+        slot = (fp, build())
+        st.session_state[key] = slot
+    if slot is not None:
+        st.download_button(f'Télécharger {label}', slot[1], file, mime, key=key + '_download')
+
+def safe_csv(label, df, file, fp):
+    if df is None: st.button(label, disabled=True)
+    else: prepared_download(file, label, file, 'text/csv', fp, lambda: export_csv(df))
 
 # -----------------------------------------------------------------------------
 # UI
@@ -399,41 +629,42 @@ with c3:
     f_prev2=st.file_uploader('Mois N-2 (historique)',type=['xlsx','xls','csv'],key='prev2')
 with c4:
     if st.button('Forcer relecture'):
-        st.cache_data.clear(); st.rerun()
+        st.cache_data.clear()
+        for k in [k for k in st.session_state if str(k).startswith(EXPORT_STATE_PREFIX)]:
+            st.session_state.pop(k, None)
+        st.session_state.pop('_validations_idx', None); st.rerun()
 
 if f_cur:
     # lectures
-    cur=normalize(read_any(f_cur.getvalue(),f_cur.name))
-    hist=pd.DataFrame()
-    if f_prev: hist=normalize(read_any(f_prev.getvalue(),f_prev.name))
-    if f_prev2:
-        hist2=normalize(read_any(f_prev2.getvalue(),f_prev2.name))
-        hist=pd.concat([hist,hist2],ignore_index=True) if not hist.empty else hist2
+    uploads_fp=fingerprint(*[p for f in (f_cur,f_prev,f_prev2) for p in ((f.name,f.getvalue()) if f else ('',))])
+    # une seule normalisation par fichier, partagée par les calculs et le contrôle qualité
+    files=[]
+    for label,f in [('Mois courant',f_cur),('Mois N-1',f_prev),('Mois N-2',f_prev2)]:
+        if f:
+            raw=read_any(f.getvalue(),f.name)
+            files.append((label,raw,normalize(raw)))
+    cur=files[0][2]
+    hists=[norm for _,_,norm in files[1:]]
+    hist=pd.concat(hists,ignore_index=True) if len(hists)>1 else (hists[0] if hists else pd.DataFrame())
+
+    # contrôle qualité avant affichage des onglets (gardé en session par empreinte des fichiers)
+    show_quality_report(quality_report(files, uploads_fp))
 
     t1,t2,t3=st.tabs(['Créateurs','Agents','Managers'])
 
     with t1:
         crea=compute_creators(cur,hist)
         st.dataframe(crea,use_container_width=True)
-        st.download_button('CSV Créateurs',crea.to_csv(index=False).encode('utf-8'),'recompenses_createurs.csv','text/csv')
+        safe_csv('CSV Créateurs', crea, 'recompenses_createurs.csv', uploads_fp)
         safe_pdf('PDF Créateurs','Récompenses Créateurs',crea,'recompenses_createurs.pdf')
 
         # ---- panneau admin UNIQUEMENT si is_admin() ----
         if is_admin():
             st.subheader("Validation admin")
-            vals_old = load_validations()
-
             edit_df = crea[['creator_id','creator_username','periode','recompense_palier_1','recompense_palier_2','bonus_debutant']].copy()
-            edit_df['valide_recompense'] = False
-            edit_df['valide_bonus'] = False
-            if not vals_old.empty:
-                m = vals_old[['creator_id','periode','valide_recompense','valide_bonus']].copy()
-                m['valide_recompense'] = m['valide_recompense'].astype(str).str.lower().isin(['true','1','yes','oui'])
-                m['valide_bonus'] = m['valide_bonus'].astype(str).str.lower().isin(['true','1','yes','oui'])
-                edit_df = edit_df.merge(m, on=['creator_id','periode'], how='left', suffixes=('','_hist'))
-                edit_df['valide_recompense'] = np.where(edit_df['valide_recompense_hist'].notna(), edit_df['valide_recompense_hist'], edit_df['valide_recompense'])
-                edit_df['valide_bonus'] = np.where(edit_df['valide_bonus_hist'].notna(), edit_df['valide_bonus_hist'], edit_df['valide_bonus'])
-                edit_df.drop(columns=['valide_recompense_hist','valide_bonus_hist'], inplace=True)
+            found = validations_index().reindex(pd.MultiIndex.from_frame(edit_df[VALIDATION_KEY].astype(str)))
+            edit_df['valide_recompense'] = found['valide_recompense'].eq(True).to_numpy()
+            edit_df['valide_bonus'] = found['valide_bonus'].eq(True).to_numpy()
 
             edited = st.data_editor(
                 edit_df,
@@ -448,9 +679,13 @@ if f_cur:
             )
 
             if st.button("Enregistrer les validations"):
-                out = edited[['creator_id','periode','valide_recompense','valide_bonus']].copy()
-                out['valide_recompense'] = out['valide_recompense'].astype(bool)
-                out['valide_bonus'] = out['valide_bonus'].astype(bool)
+                # Seules les lignes réellement modifiées dans l'éditeur sont envoyées
+                rec = edited['valide_recompense'].astype(bool).to_numpy()
+                bon = edited['valide_bonus'].astype(bool).to_numpy()
+                changed = (rec != edit_df['valide_recompense'].to_numpy()) | (bon != edit_df['valide_bonus'].to_numpy())
+                out = edited.loc[changed, ['creator_id','periode']].copy()
+                out['valide_recompense'] = rec[changed]
+                out['valide_bonus'] = bon[changed]
                 out['timestamp_iso'] = datetime.utcnow().isoformat()
                 save_validations(out)
                 try: st.toast("✅ Données enregistrées", icon="✅")
@@ -482,7 +717,7 @@ if f_cur:
             ag = apply_agent_manager_settings(edited, kind="agent")
             st.dataframe(ag, use_container_width=True)
 
-        st.download_button('CSV Agents', ag.to_csv(index=False).encode('utf-8'), 'recompenses_agents.csv', 'text/csv')
+        safe_csv('CSV Agents', ag, 'recompenses_agents.csv', fingerprint(uploads_fp, ag))
         safe_pdf('PDF Agents', 'Récompenses Agents', ag, 'recompenses_agents.pdf')
 
     with t3:
@@ -511,9 +746,25 @@ if f_cur:
             man = apply_agent_manager_settings(edited, kind="manager")
             st.dataframe(man, use_container_width=True)
 
-        st.download_button('CSV Managers', man.to_csv(index=False).encode('utf-8'), 'recompenses_managers.csv', 'text/csv')
+        safe_csv('CSV Managers', man, 'recompenses_managers.csv', fingerprint(uploads_fp, man))
         safe_pdf('PDF Managers', 'Récompenses Managers', man, 'recompenses_managers.pdf')
 
+    # Export unique : un classeur avec toutes les feuilles, construit à la demande
+    admin = is_admin()
+    def build_xlsx():
+        sheets = {'Créateurs': crea, 'Agents': ag, 'Managers': man}
+        if admin:
+            sheets['Validations'] = validations_for(crea)
+        return export_xlsx(sheets)
+    prepared_download(
+        'xlsx',
+        "l'XLSX complet" + (' (avec validations)' if admin else ''),
+        'recompenses.xlsx',
+        XLSX_MIME,
+        fingerprint(uploads_fp, ag, man, admin, *([validations_index()] if admin else [])),
+        build_xlsx,
+    )
+
 # -----------------------------------------------------------------------------
 # Footer
 # -----------------------------------------------------------------------------